@@ -11,3 +11,8 @@ CREATE TABLE IF NOT EXISTS Return (
         TradingDay
     )
 );
+
+CREATE UNIQUE INDEX IF NOT EXISTS ux_code_day ON Return (
+    Code,
+    TradingDay
+);
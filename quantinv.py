@@ -1,24 +1,48 @@
 #!/usr/bin/python3
 # -*- coding: UTF-8 -*-
 import argparse
-import json
+import csv
 import math
 import os
-import re
 import sqlite3
 import sys
-import time
-from typing import List, Union
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, repeat
+from typing import Dict, List, Tuple, Union
 import numpy as np
 
 import pandas as pd
 import requests
-from bs4 import BeautifulSoup as bs
+from requests.adapters import HTTPAdapter
+from lxml import html as lhtml
+
+try:
+    # 装了orjson就用它解析接口返回的json，比标准库快，还能直接解析memoryview切片
+    import orjson as _json
+
+    _view = memoryview
+except ImportError:
+    import json as _json
+
+    _view = bytes
+
+try:
+    # 装了requests-cache就把接口返回缓存到本地sqlite，一小时内重跑不再访问网络
+    from requests_cache import CachedSession
+except ImportError:
+    CachedSession = None
 
 from utils import logger
 
 # 爬虫爬一页数据条目数
 PAGESIZE = 1000
+# 爬虫同时请求的页数，所有基金合计
+PAGE_WORKERS = 16
+# 爬虫同时爬取的基金数
+FUND_WORKERS = 4
+# 历史净值接口url
+URL_LSJZ = "http://api.fund.eastmoney.com/f10/lsjz?callback=jQuery18305293200554312854_1705643555097"
 # 一年的自然日数
 YEAR_TNR = 365
 # 一年的工作日数
@@ -31,12 +55,30 @@ FUND_NUM = 20
 NAME_TAB = "Return"
 # 数据库路径
 PATH_SQL = "EMFund.db"
+# 数据表DDL路径，连接时数据表不存在才执行，建表和唯一索引
+PATH_DDL = "EMFund.sql"
+# 已有数据表的唯一索引，第一次写入前才建，只出报告的运行不改数据库文件
+SQL_INDEX = f"CREATE UNIQUE INDEX IF NOT EXISTS ux_code_day ON {NAME_TAB} (Code, TradingDay);"
+# 连接数据库后设置的PRAGMA：降低fsync频率、临时表放内存、64MB页缓存，都只对当前连接有效
+SQL_PRAGMA = """
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA cache_size=-64000;
+"""
 # 本地数据文件路径
 PATH_LDB = "data/local_db.csv"
 # 临时数据保存路径
 DATA_DIR = "data"
 if not os.path.exists(DATA_DIR):
     os.mkdir(DATA_DIR)
+# 接口返回缓存文件路径，装了requests-cache才会用到
+PATH_CACHE = f"{DATA_DIR}/http_cache.sqlite"
+# 所有请求共用一个会话，第一次请求时才创建，只出报告的运行不会建会话和缓存文件
+SESSION = None
+# 所有基金共用一个请求页的线程池，页数多的基金可以用上其他基金空出来的线程，同样第一次请求时才创建
+PAGE_POOL = None
+# 创建共用会话和线程池时加的锁
+_LAZY_LOCK = threading.Lock()
 # 爬取到的列名转成数据库列名的映射
 NAME_MAP = {
     "FSRQ": "TradingDay",
@@ -46,6 +88,146 @@ NAME_MAP = {
 }
 # 需要保存的数据库
 SAVE_COL = ["Code", "Name", "TradingDay", "UnitNAV", "CumNAV", "Return"]
+# 当日回撤 = 累计净值 / 该基金截至当日的最高累计净值 - 1
+SQL_DD = "CumNAV * 1.0 / MAX(CumNAV) OVER (PARTITION BY Code ORDER BY TradingDay) - 1"
+# 数据库模式下按基金汇总的SQL，基金按写入顺序输出，名称取该基金最后一个交易日的名称
+SQL_FUND = f"""
+SELECT Code, MIN(lname) AS Name, MIN(TradingDay) AS first, MAX(TradingDay) AS last,
+       SUM(LN(1 + Return)) AS lret, MIN(dd) AS mdd,
+       SUM(Return) AS s1, SUM(Return * Return) AS s2, COUNT(Return) AS n
+FROM (
+    SELECT *, rowid AS rid, {SQL_DD} AS dd,
+           FIRST_VALUE(Name) OVER (PARTITION BY Code ORDER BY TradingDay DESC) AS lname
+    FROM {NAME_TAB}
+)
+GROUP BY Code
+ORDER BY MIN(rid);
+"""
+# 数据库模式下按基金+年汇总的SQL，每年第一个交易日的return不计入当年收益
+SQL_YEAR = f"""
+SELECT Code, Year, MIN(dd) AS mdd,
+       SUM(CASE WHEN TradingDay = fday THEN 0 ELSE LN(1 + Return) END) AS lret,
+       SUM(Return) AS s1, SUM(Return * Return) AS s2, COUNT(Return) AS n
+FROM (
+    SELECT *, CAST(substr(TradingDay, 1, 4) AS INTEGER) AS Year,
+           MIN(TradingDay) OVER (PARTITION BY Code, substr(TradingDay, 1, 4)) AS fday,
+           {SQL_DD} AS dd
+    FROM {NAME_TAB}
+)
+GROUP BY Code, Year;
+"""
+# 数据库模式下按基金+月汇总的SQL，每月第一个交易日的return不计入当月收益，名称取当月最后一个交易日的名称
+SQL_MONTH = f"""
+SELECT Code, MIN(lname) AS Name, Month,
+       SUM(CASE WHEN TradingDay = fday THEN 0 ELSE LN(1 + Return) END) AS lret
+FROM (
+    SELECT *, substr(TradingDay, 1, 7) AS Month,
+           MIN(TradingDay) OVER (PARTITION BY Code, substr(TradingDay, 1, 7)) AS fday,
+           FIRST_VALUE(Name) OVER (
+               PARTITION BY Code, substr(TradingDay, 1, 7) ORDER BY TradingDay DESC
+           ) AS lname
+    FROM {NAME_TAB}
+)
+GROUP BY Code, Month
+ORDER BY Code, Month;
+"""
+# 插入数据库的预编译语句，(Code, TradingDay)重复的条目由唯一索引直接忽略
+INSERT_SQL = f"INSERT OR IGNORE INTO {NAME_TAB}({','.join(SAVE_COL)}) VALUES({','.join('?' * len(SAVE_COL))})"
+
+
+def get_session() -> requests.Session:
+    """
+    取所有请求共用的会话，第一次调用时创建，复用TCP连接，要求服务器压缩返回内容
+
+    Returns:
+    - requests.Session: 共用的会话，装了requests-cache时是带本地缓存的CachedSession
+    """
+    global SESSION
+    # 已经建好就直接用，只有第一次创建时才加锁，避免多个线程各建一个
+    if SESSION is not None:
+        return SESSION
+    with _LAZY_LOCK:
+        if SESSION is not None:
+            return SESSION
+        if CachedSession is not None:
+            ses = CachedSession(
+                PATH_CACHE,
+                backend="sqlite",
+                expire_after=3600,
+                allowable_methods=("GET",),
+            )
+        else:
+            ses = requests.Session()
+        ses.headers.update(
+            {
+                "Accept-Encoding": "gzip, deflate",
+                "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36",
+            }
+        )
+        # 连接池要容纳所有并发请求（各基金的第一页加上页线程池），否则多出来的连接用完就被丢弃
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=PAGE_WORKERS + FUND_WORKERS)
+        ses.mount("http://", adapter)
+        ses.mount("https://", adapter)
+        SESSION = ses
+    return SESSION
+
+
+def get_page_pool() -> ThreadPoolExecutor:
+    """
+    取所有基金共用的请求页线程池，第一次调用时创建
+
+    Returns:
+    - ThreadPoolExecutor: 共用的线程池，最多PAGE_WORKERS个线程
+    """
+    global PAGE_POOL
+    # 和get_session()一样，只有第一次创建时才加锁
+    if PAGE_POOL is not None:
+        return PAGE_POOL
+    with _LAZY_LOCK:
+        if PAGE_POOL is None:
+            PAGE_POOL = ThreadPoolExecutor(max_workers=PAGE_WORKERS)
+    return PAGE_POOL
+
+
+def write_csv(
+    data: pd.DataFrame, path: str, columns: List[str] = None, append: bool = False
+) -> None:
+    """
+    把DataFrame写成不带索引的csv文件
+
+    Parameters:
+    - data (pd.DataFrame): 要写出的数据
+    - path (str): 输出路径
+    - columns (List[str]): 只写出这些列，默认全部，不用先切出一张新表
+    - append (bool): 是否追加到已有文件末尾，追加时不写表头
+    """
+    # 统一用pandas写出，文件格式不随可选依赖变化
+    data.to_csv(
+        path,
+        columns=columns,
+        index=False,
+        mode="a" if append else "w",
+        header=not append,
+    )
+    return
+
+
+def sample_std(s1: np.ndarray, s2: np.ndarray, n: np.ndarray) -> np.ndarray:
+    """
+    由每组收益的和、平方和、期数算样本标准差，只有一期收益的组没有标准差
+
+    Parameters:
+    - s1 (np.ndarray): 每组收益的和
+    - s2 (np.ndarray): 每组收益的平方和
+    - n (np.ndarray): 每组收益的期数
+
+    Returns:
+    - np.ndarray: 每组收益的样本标准差
+    """
+    # 和pandas的std一致，除以n-1
+    with np.errstate(divide="ignore", invalid="ignore"):
+        var = (s2 - s1**2 / n) / (n - 1)
+    return np.where(n > 1, np.sqrt(np.clip(var, 0, None)), np.nan)
 
 
 class EMFund(object):
@@ -53,6 +235,13 @@ class EMFund(object):
         self.code = code
         self.name = name
         self.data = []
+        # 按列存的数据，数值列是float数组，格式化DataFrame时不用逐行推断类型
+        self._col = {
+            "FSRQ": [],
+            "DWJZ": np.empty(0),
+            "LJJZ": np.empty(0),
+            "JZZZL": np.empty(0),
+        }
 
     def get_data(self) -> List:
         """
@@ -73,11 +262,17 @@ class EMFund(object):
         Returns:
         - pandas.DataFrame: 基金历史数据表
         """
-        ret = pd.DataFrame().from_records(self.data)
-        ret["Code"] = self.code
-        ret["Name"] = self.name
-        ret.rename(columns=NAME_MAP, inplace=True)
-        ret = ret[SAVE_COL]
+        ret = pd.DataFrame(
+            {
+                "Code": self.code,
+                "Name": self.name,
+                "TradingDay": self._col["FSRQ"],
+                "UnitNAV": self._col["DWJZ"],
+                "CumNAV": self._col["LJJZ"],
+                "Return": self._col["JZZZL"],
+            },
+            columns=SAVE_COL,
+        )
         return ret
 
     def export_data(self, path: str) -> None:
@@ -91,46 +286,73 @@ class EMFund(object):
             logger.warning(
                 f"{self.code} {self.name} has no data, call get_data() first"
             )
-        temp = self.format_dataframe()
         if path.endswith("html"):
+            temp = self.format_dataframe()
             temp.to_html(path, index=False)
         else:
-            temp.to_csv(path, index=False)
+            # csv直接按列逐行写出，不用先构造DataFrame
+            with open(path, "w", newline="", encoding="utf-8") as f:
+                writer = csv.writer(f, lineterminator="\n")
+                writer.writerow(SAVE_COL)
+                writer.writerows(
+                    zip(
+                        repeat(self.code),
+                        repeat(self.name),
+                        self._col["FSRQ"],
+                        self._col["DWJZ"].tolist(),
+                        self._col["LJJZ"].tolist(),
+                        self._col["JZZZL"].tolist(),
+                    )
+                )
         return
 
     # def refresh_data(self) -> None:
     #     self._scrape_data()
     #     return
 
-    def _scrape_data(self) -> None:
+    def _fetch_page(self, idx: int) -> Dict:
         """
-        从网页爬取基金历史数据
-        
+        请求一页基金历史数据
+
+        Parameters:
+        - idx (int): 页码，从1开始
+
+        Returns:
+        - Dict: 接口返回的json内容
+
         Raises:
         - ValueError: 无法解析爬到的数据
-        - KeyError: 爬到的数据缺必要字段
         """
-        # 准备目标url
-        page = 1
-        size = PAGESIZE
-        base = "http://api.fund.eastmoney.com/f10/lsjz?callback=jQuery18305293200554312854_1705643555097"
         pars = {
             "fundCode": self.code,
-            "pageIndex": page,
-            "pageSize": size,
+            "pageIndex": idx,
+            "pageSize": PAGESIZE,
         }
         head = {"Referer": f"http://fundf10.eastmoney.com/jjjz_{self.code}.html"}
         # 请求url并解析返回的内容
-        rsp = requests.get(base, headers=head, params=pars).content.decode()
-        pat = re.compile(r"\((.*?)\)")
-        mat = re.search(pat, rsp)
-        if mat:
-            dat = json.loads(mat.group(1))
-            logger.debug(f"load fund metadata online success")
-        else:
-            msg = "load fund metadata online failure"
+        # 直接用原始字节，json解析器能直接解析utf-8字节，省掉一次解码
+        rsp = get_session().get(URL_LSJZ, headers=head, params=pars).content
+        # 返回内容是callback(json)的JSONP格式，直接切出第一个左括号和最后一个右括号之间的json
+        beg = rsp.find(b"(")
+        end = rsp.rfind(b")")
+        if beg < 0 or end < beg:
+            msg = f"parse fund data failure, page {idx}"
             logger.error(msg)
             raise ValueError(msg)
+        # orjson下切的是memoryview，不再复制一份json字节
+        return _json.loads(_view(rsp)[beg + 1 : end])
+
+    def _scrape_data(self) -> None:
+        """
+        从网页爬取基金历史数据
+        
+        Raises:
+        - ValueError: 无法解析爬到的数据
+        - KeyError: 爬到的数据缺必要字段
+        """
+        # 先请求第一页
+        dat = self._fetch_page(1)
+        logger.debug(f"load fund metadata online success")
         try:
             # 获取当前基金历史数据条目总数
             cnt = dat["TotalCount"]
@@ -140,29 +362,39 @@ class EMFund(object):
             logger.error(msg)
             raise KeyError(msg)
         # 算出需要请求几页
-        pag = math.ceil(cnt / size)
-        # 每页请求
-        for idx in range(pag):
-            time.sleep(0.5)
-            pars["pageIndex"] = idx + 1
-            rsp = requests.get(base, headers=head, params=pars).content.decode()
-            mat = re.search(pat, rsp)
-            if mat:
-                dat = json.loads(mat.group(1))
-            else:
-                msg = "parse fund data failure"
-                logger.error(msg)
-                raise ValueError(msg)
-            # 先把json转成DataFrame
-            tmp = pd.DataFrame().from_records(dat["Data"]["LSJZList"])
-            # 累计净值转成float
-            tmp["LJJZ"] = tmp["LJJZ"].astype(float)
-            # 用两天之间的净值差，倒算出精确的当日净值增长率
-            tmp["JZZZL"] = (tmp["LJJZ"] - tmp["LJJZ"].shift(-1)) / tmp["LJJZ"].shift(-1)
-            # 第一天的净值增长率是0
-            tmp["JZZZL"].values[-1] = 0
-            # 转回data规定的List格式
-            self.data += tmp.to_dict(orient="records")
+        pag = math.ceil(cnt / PAGESIZE)
+        # 条目总数已知，预先分配好列表，所有页的记录按日期倒序依次填进去
+        rec = [None] * cnt
+        off = 0
+        # 第一页已经拿到了，直接复用；剩下的页交给共用线程池并发请求，map保证结果按页码顺序返回
+        pages = get_page_pool().map(self._fetch_page, range(2, pag + 1))
+        for dat in chain([dat], pages):
+            # 每页到了就把记录填进去，整页的返回内容随即可以释放，不再攒着所有页
+            rows = dat["Data"]["LSJZList"]
+            rec[off : off + len(rows)] = rows
+            off += len(rows)
+        del dat, rows
+        # 实际条目数和TotalCount对不上时，去掉没填的位置
+        del rec[off:]
+        # 单位净值和累计净值转成float数组
+        uj = np.fromiter((float(r["DWJZ"]) for r in rec), dtype=np.float64, count=len(rec))
+        lj = np.fromiter((float(r["LJJZ"]) for r in rec), dtype=np.float64, count=len(rec))
+        # 用两天之间的净值差，倒算出精确的当日净值增长率，整段一起算避免页边界断开
+        # 第一天的净值增长率是0
+        jz = np.zeros_like(lj)
+        jz[:-1] = (lj[:-1] - lj[1:]) / lj[1:]
+        # 直接写回原记录，保持data规定的List格式
+        for r, l, z in zip(rec, lj.tolist(), jz.tolist()):
+            r["LJJZ"] = l
+            r["JZZZL"] = z
+        self.data += rec
+        # 同时按列存一份
+        self._col = {
+            "FSRQ": [r["FSRQ"] for r in rec],
+            "DWJZ": uj,
+            "LJJZ": lj,
+            "JZZZL": jz,
+        }
         return
 
 
@@ -180,6 +412,16 @@ class DBFund(object):
         self.db_curs = None
         # 数据库是否装载
         self.db_load = False
+        # 还没写入数据库的新增数据，save()时一次性写入
+        self._unsaved = []
+        # 已有数据的(Code, TradingDay)集合，用来筛掉重复条目
+        self._seen = set()
+        # 还没拼到self.pdata上的新增数据，用到self.pdata时再一次性拼接
+        self._buffer = []
+        # 数据库模式下唯一索引是否已经确认存在
+        self._indexed = False
+        # 本地模式下self.pdata前多少行已经在本地数据文件里，save()时只追加后面的新行
+        self._nsaved = 0
         if local:
             # 本地模式
             logger.warning(f"DBFund running with local file: {PATH_LDB}, ignore db")
@@ -204,27 +446,126 @@ class DBFund(object):
         """
         try:
             self.db_conn = sqlite3.connect(self.db_path)
+            self.db_conn.executescript(SQL_PRAGMA)
             self.db_curs = self.db_conn.cursor()
             logger.info(f"Connected to sqlite db: {self.db_path}")
         except sqlite3.Error as e:
             logger.error(f"Error connecting to sqlite db: {e}")
+            return
+        # 只有数据表不存在时才执行DDL建表，已有的数据库文件只读不改
+        query = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;"
+        if self.db_conn.execute(query, (NAME_TAB,)).fetchone() is None:
+            try:
+                with open(PATH_DDL, encoding="utf-8") as f:
+                    self.db_conn.executescript(f.read())
+                logger.info(f"Created table {NAME_TAB} from {PATH_DDL}")
+            except (OSError, sqlite3.Error) as e:
+                logger.error(f"Error creating table {NAME_TAB} from {PATH_DDL}: {e}")
+        try:
+            self.db_conn.execute("SELECT LN(1);")
+        except sqlite3.OperationalError:
+            # SQLite没有编译数学函数时，注册Python实现的LN
+            self.db_conn.create_function("LN", 1, math.log, deterministic=True)
+
+    def _ensure_index(self) -> None:
+        """
+        写入前确保(Code, TradingDay)唯一索引存在，INSERT OR IGNORE靠它去重
+
+        Raises:
+        - sqlite3.IntegrityError: 表里已经有(Code, TradingDay)重复的条目，建不了唯一索引
+        """
+        if self._indexed:
+            return
+        try:
+            self.db_conn.execute(SQL_INDEX)
+        except sqlite3.IntegrityError as e:
+            msg = (
+                f"cannot create unique index on {NAME_TAB}(Code, TradingDay), "
+                f"table has duplicate (Code, TradingDay) rows under different Names: {e}"
+            )
+            logger.error(msg)
+            raise sqlite3.IntegrityError(msg)
+        self._indexed = True
+        return
 
     def load(self) -> None:
         """
-        从数据库装载数据
+        从数据库装载数据，数据库模式下只建立连接，数据留在数据库里按需聚合
         """
         if self.local:
             if os.path.exists(PATH_LDB):
                 # 本地模式下，能找到本地数据文件，读入self.pdata
-                self.pdata = pd.read_csv(PATH_LDB, dtype={"Code": str})
+                self.pdata = pd.read_csv(
+                    PATH_LDB, dtype={"Code": "category", "Name": "category"}
+                )
+                self.pdata = self._parse_days(self.pdata)
+                self._nsaved = len(self.pdata)
+                self._seen = set(
+                    zip(self.pdata["Code"].to_numpy(), self.pdata["TradingDay"].to_numpy())
+                )
         else:
             # 数据库模式下
             if self.db_conn is None:
                 # 如果数据连接还没建立，先建立连接
                 self.connect()
-            query = f"SELECT * FROM {NAME_TAB};"
-            # 从数据库中读所有数据到self.pdata
-            self.pdata = pd.read_sql_query(query, self.db_conn)
+            # 不把整张表读进内存，指标直接在SQLite里聚合
+            self.db_load = True
+        return
+
+    def _parse_days(self, data: pd.DataFrame) -> pd.DataFrame:
+        """
+        解析交易日，加上日期列和整数年份列，只需要在数据进入self.pdata时做一次
+
+        Parameters:
+        - data (pandas.DataFrame): 基金数据
+
+        Returns:
+        - pandas.DataFrame: 原地加上TradingDayDT和Year列的同一张表
+        """
+        day = pd.to_datetime(data["TradingDay"], format="%Y-%m-%d", cache=True)
+        # 传进来的都是新拼出来或新读入的表，直接加列，不再复制一份
+        data["TradingDayDT"] = day
+        data["Year"] = day.dt.year.astype("int16")
+        return data
+
+    def _materialize(self) -> None:
+        """
+        把缓存的新增数据一次性拼到self.pdata上，避免每次add都复制整张表
+        """
+        if len(self._buffer) == 0:
+            return
+        new = self._parse_days(pd.concat(self._buffer, ignore_index=True))
+        if len(self.pdata) == 0:
+            self.pdata = new
+        else:
+            self.pdata = pd.concat([self.pdata, new], ignore_index=True)
+        # 基金代码和名称大量重复，存成category，分组时直接用整数编码
+        # 只替换这两列，不用astype复制整张表
+        for col in ("Code", "Name"):
+            self.pdata[col] = self.pdata[col].astype("category")
+        self._buffer.clear()
+        return
+
+    def _flush(self) -> None:
+        """
+        数据库模式下，把新增数据插入数据库当前事务，commit留给save()
+        """
+        if len(self._unsaved) == 0:
+            return
+        if self.db_conn is None:
+            self.connect()
+        self._ensure_index()
+        if not self.db_conn.in_transaction:
+            # 写入期间用WAL日志，一次顺序追加代替回滚日志的多次写盘，save()时再切回来
+            self.db_conn.execute("PRAGMA journal_mode=WAL;")
+        # 所有新增数据用同一条预编译语句批量插入
+        rows = [
+            r
+            for new in self._unsaved
+            for r in new[SAVE_COL].itertuples(index=False, name=None)
+        ]
+        self.db_conn.executemany(INSERT_SQL, rows)
+        self._unsaved.clear()
         return
 
     def empty(self) -> bool:
@@ -234,34 +575,38 @@ class DBFund(object):
         Returns:
         - bool: 是否为空
         """
+        if not self.local:
+            if len(self._unsaved) > 0:
+                return False
+            if self.db_conn is None:
+                self.connect()
+            # 数据库模式只查有没有数据，不读数据
+            query = f"SELECT EXISTS (SELECT 1 FROM {NAME_TAB});"
+            return not self.db_conn.execute(query).fetchone()[0]
+        self._materialize()
         return len(self.pdata) == 0
 
     def add(self, fund: Union[EMFund, pd.DataFrame]) -> None:
         """
-        将一个基金所有数据加入数据库
+        将一个基金所有数据加入数据库，数据库模式下要调用save()才会写入
         
         Parameters:
         - fund: 需要加入的基金
         """
         # 如果fund是EMFund类型则需要导出pandas.DataFrame类型的数据
         tmp = fund.format_dataframe() if isinstance(fund, EMFund) else fund
-        # 接下来筛选不存在于原来数据库中的条目
-        if len(self.pdata) == 0:
-            # 如果数据库整体为空，那么直接全加入
-            new = tmp
-        else:
-            # 不然按key=Code+TradingDay，筛选没出现过的
-            idx = ~(tmp["Code"] + tmp["TradingDay"]).isin(
-                self.pdata["Code"] + self.pdata["TradingDay"]
-            )
-            new = tmp[idx]
         if not self.local:
-            if self.db_conn is None:
-                self.connect()
-            # 如果不是本地模式，还要插入数据库中
-            new.to_sql(NAME_TAB, self.db_conn, index=False, if_exists="append")
-        # 无论是不是本地模式，都要append到self.pdata上
-        self.pdata = pd.concat([self.pdata, new])
+            # 如果不是本地模式，先记下来，save()时再插入数据库中，重复条目由唯一索引忽略
+            self._unsaved.append(tmp)
+            return
+        # 接下来按key=(Code, TradingDay)，筛选不存在于原来数据库中的条目
+        key = list(zip(tmp["Code"].to_numpy(), tmp["TradingDay"].to_numpy()))
+        idx = np.fromiter((k not in self._seen for k in key), dtype=bool, count=len(key))
+        new = tmp[idx]
+        # 登记新出现的key，只和新增条目数有关，不用重新拼接整个数据库
+        self._seen.update(key)
+        # append到self.pdata上，先放进缓存
+        self._buffer.append(new)
         return
 
     def save(self) -> None:
@@ -270,14 +615,158 @@ class DBFund(object):
 
         """
         if self.local:
+            self._materialize()
             # 本地模式，输出csv文件到默认路径
-            self.pdata.to_csv(PATH_LDB, index=False)
+            if self._nsaved == 0:
+                # 文件里还没有数据，整张表写出
+                write_csv(self.pdata, PATH_LDB, columns=SAVE_COL)
+            elif self._nsaved < len(self.pdata):
+                # 新增数据已经去过重，都拼在self.pdata末尾，只追加这些行
+                new = self.pdata.iloc[self._nsaved :]
+                write_csv(new, PATH_LDB, columns=SAVE_COL, append=True)
+            self._nsaved = len(self.pdata)
         else:
+            # 数据库模式，所有新增数据在一个事务里插入
+            self._flush()
             if self.db_conn:
-                # 数据库模式，再commit一下保证所有状态都写入
+                # 只需要一次commit保证所有状态都写入
                 self.db_conn.commit()
+                # WAL模式会持久记在数据库文件里，切回默认的回滚日志，
+                # 同时把WAL里的数据写回数据库文件并删掉-wal文件，单独拷走.db文件不会丢数据
+                self.db_conn.execute("PRAGMA journal_mode=DELETE;")
         return
 
+    def _sql_stats(self, query: str) -> pd.DataFrame:
+        """
+        在数据库里执行聚合查询，由各期收益平方和算出样本标准差
+
+        Parameters:
+        - query (str): SQL_FUND/SQL_YEAR/SQL_MONTH之一
+
+        Returns:
+        - pandas.DataFrame: 聚合结果
+        """
+        # 还没commit的新增数据也要算进去
+        self._flush()
+        ret = pd.read_sql_query(query, self.db_conn)
+        if "n" in ret:
+            ret["std"] = sample_std(ret["s1"], ret["s2"], ret["n"])
+        return ret
+
+    def _year_stats(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        汇总年度报告要用的统计量，本地模式在self.pdata上算，数据库模式在SQLite里聚合
+
+        Returns:
+        - pandas.DataFrame: 按基金汇总，index是Code，列是Name、first、last、lret、std、mdd
+        - pandas.DataFrame: 按基金+年汇总，index是(Code, Year)，列是lret、std、mdd
+        """
+        if not self.local:
+            tot = self._sql_stats(SQL_FUND).set_index("Code")
+            tot["first"] = pd.to_datetime(tot["first"], format="%Y-%m-%d")
+            tot["last"] = pd.to_datetime(tot["last"], format="%Y-%m-%d")
+            yut = self._sql_stats(SQL_YEAR).set_index(["Code", "Year"])
+            return tot, yut
+        self._materialize()
+        src = self.pdata
+        # 基金按出现顺序编号，按基金+日期排序，同一基金、同一基金同一年的数据都是连续的一段
+        cid, codes = pd.factorize(src["Code"])
+        day = src["TradingDayDT"].to_numpy()
+        odr = np.lexsort((day, cid))
+        cid, day = cid[odr], day[odr]
+        year = src["Year"].to_numpy()[odr]
+        rtn = src["Return"].to_numpy()[odr]
+        nav = src["CumNAV"].to_numpy()[odr]
+        # 每个基金的起点，和每个基金每年的起点（也就是当年第一个交易日）
+        fbeg = np.flatnonzero(np.diff(cid, prepend=-1) != 0)
+        ybeg = np.flatnonzero(
+            (np.diff(cid, prepend=-1) != 0) | (np.diff(year, prepend=-1) != 0)
+        )
+        # 缺失的return不参与求和和计数
+        cnt = ~np.isnan(rtn)
+        rtn = np.where(cnt, rtn, 0.0)
+        # 复利用对数收益率求和再还原，每年第一个交易日的return不计入当年收益
+        lret = np.log1p(rtn)
+        # 先按基金求总和，再原地把每年第一天清零按年求和，不用复制一份
+        flret = np.add.reduceat(lret, fbeg)
+        lret[ybeg] = 0.0
+        # 算每天相对该基金历史最高累计净值的回撤
+        dd = nav / pd.Series(nav).groupby(cid).cummax().to_numpy() - 1
+        # 收益的和、平方和、期数，所有分段各用一次reduceat求出，不走groupby的哈希
+        sq = rtn * rtn
+        cnt = cnt.astype(np.int64)
+        # 按基金整体计算，基金按原来的出现顺序
+        fend = np.append(fbeg[1:], len(day)) - 1
+        tot = pd.DataFrame(
+            {
+                # 基金改过名时取最后一个交易日的名称
+                "Name": src["Name"].iloc[odr[fend]].to_numpy(),
+                "first": day[fbeg],
+                "last": day[fend],
+                "lret": flret,
+                "mdd": np.fmin.reduceat(dd, fbeg),
+                "std": sample_std(
+                    np.add.reduceat(rtn, fbeg),
+                    np.add.reduceat(sq, fbeg),
+                    np.add.reduceat(cnt, fbeg),
+                ),
+            },
+            index=pd.Index(np.asarray(codes, dtype=object), name="Code"),
+        )
+        # 按基金+年计算
+        yut = pd.DataFrame(
+            {
+                "lret": np.add.reduceat(lret, ybeg),
+                "mdd": np.fmin.reduceat(dd, ybeg),
+                "std": sample_std(
+                    np.add.reduceat(rtn, ybeg),
+                    np.add.reduceat(sq, ybeg),
+                    np.add.reduceat(cnt, ybeg),
+                ),
+            },
+            index=pd.MultiIndex.from_arrays(
+                [tot.index[cid[ybeg]], year[ybeg]], names=["Code", "Year"]
+            ),
+        )
+        return tot, yut
+
+    def _month_stats(self) -> pd.DataFrame:
+        """
+        汇总月度报告要用的统计量，本地模式在self.pdata上算，数据库模式在SQLite里聚合
+
+        Returns:
+        - pandas.DataFrame: 按基金+月汇总，列是Code、Name、Month(YYYY-MM)、lret
+        """
+        if not self.local:
+            return self._sql_stats(SQL_MONTH)
+        self._materialize()
+        src = self.pdata
+        # 基金编号化，日期和月份转成整数
+        cid, codes = pd.factorize(src["Code"], sort=True)
+        day = src["TradingDayDT"].to_numpy()
+        mon = day.astype("datetime64[M]")
+        # 按基金+日期排序，同一基金同一月的数据连续，每段开头就是该月第一个交易日
+        odr = np.lexsort((day, cid))
+        cid, mon = cid[odr], mon[odr]
+        beg = np.flatnonzero(
+            (np.diff(cid, prepend=-1) != 0) | (np.diff(mon.view("i8"), prepend=-1) != 0)
+        )
+        # 复利用对数收益率求和再还原，每月第一个交易日的return不计入当月收益
+        lret = np.nan_to_num(np.log1p(src["Return"].to_numpy()[odr]))
+        lret[beg] = 0.0
+        # 每段的结尾是该月最后一个交易日，基金改过名时取这天的名称
+        end = np.append(beg[1:], len(cid)) - 1
+        # 一次reduceat按段求和，不用逐组调用
+        ret = pd.DataFrame(
+            {
+                "Code": codes[cid[beg]],
+                "Name": src["Name"].iloc[odr[end]].to_numpy(),
+                "Month": np.datetime_as_string(mon[beg], unit="M"),
+                "lret": np.add.reduceat(lret, beg),
+            }
+        )
+        return ret
+
     def make_repo(self, month: bool = False) -> pd.DataFrame:
         """
         制作指标报告
@@ -288,76 +777,77 @@ class DBFund(object):
         Returns:
         - pandas.DataFrame: 报告类型是pandas表
         """
-        tmp = []
         # 月度报告
         if month:
-            # 在拷贝上操作
-            src = self.pdata.copy()
-            # 切出年和月
-            src["year"] = src["TradingDay"].str.slice(0, 4)
-            src["month"] = src["TradingDay"].str.slice(5, 7)
-            # 按基金+年+月去group
-            for key, cut in src.groupby(["Code", "year", "month"]):
-                # 子表按日期倒序排列
-                cut.sort_values(["TradingDay"], ascending=False, inplace=True)
-                # 登记该基金该年该月的指标
-                row = {
-                    "Code": key[0],
-                    "Name": cut["Name"].values[0],
-                    "Year": key[1],
-                    "Month": key[2],
-                    # 按照复利计算月收益，忽略最早那天的return
-                    "Return": (cut["Return"].values[:-1] + 1).prod() - 1,
-                }
-                tmp.append(row)
+            ret = self._month_stats()
+            # 登记每个基金每月的指标
+            ret["Year"] = ret["Month"].str.slice(0, 4)
+            ret["Month"] = ret["Month"].str.slice(5, 7)
+            # 按照复利计算月收益，忽略最早那天的return
+            ret["Return"] = np.expm1(ret["lret"])
+            ret = ret[["Code", "Name", "Year", "Month", "Return"]]
         # 年度报告
         else:
-            # 在拷贝上操作
-            src = self.pdata.copy()
-            # 按照各个基金计算
-            for cc in src["Code"].unique():
-                # 切出当前基金
-                cut = src.loc[src["Code"] == cc, :].copy()
-                # 子表按日期倒序排列
-                cut.sort_values(["TradingDay"], ascending=False, inplace=True)
-                # 初始化当前列
-                row = {"Code": cc, "Name": cut["Name"].values[0]}
-                logger.debug(f"making report for {cc} {row['Name']}")
-                # 计算产品存续期总自然日天数
-                cnt = (
-                    pd.to_datetime(cut["TradingDay"].values[0])
-                    - pd.to_datetime(cut["TradingDay"].values[-1])
-                ).days
-                # 总收益按复利计算
-                row["TotalReturn"] = (cut["Return"] + 1).prod() - 1
-                # 年化收益率 = 总收益率 / 总自然日天数 * 一年自然日天数
-                row["YearReturn"] = row["TotalReturn"] / cnt * YEAR_TNR
-                # 总夏普
-                row["TotalShapre"] = (row["YearReturn"] - RATE_R_F) / (
-                    np.std(cut["Return"]) * np.sqrt(BDAY_TNR)
-                )
-                # 总最大回撤 = 最低净值 - 1
-                row["TotalMaxDrawDown"] = cut["CumNAV"].min() - 1
-                # 按年计算指标
-                cut["year"] = cut["TradingDay"].str.slice(0, 4)
-                for yy in cut["year"].unique():
-                    # 切出当年数据
-                    yut = cut.loc[cut["year"] == yy, :].copy()
-                    logger.debug(f"making report for {cc} {row['Name']} {yy}")
-                    # 按照复利计算年收益，忽略最早那天的return
-                    row[f"{yy}_Return"] = (yut["Return"].values[:-1] + 1).prod() - 1
-                    # 年夏普
-                    row[f"{yy}_Shapre"] = (row[f"{yy}_Return"] - RATE_R_F) / (
-                        np.std(yut["Return"]) * np.sqrt(BDAY_TNR)
-                    )
-                    # 年最大回撤 = 年最低净值 - 1
-                    row[f"{yy}_MaxDrawDown"] = yut["CumNAV"].min() - 1
-                tmp.append(row)
-        # 转成pandas表返回
-        ret = pd.DataFrame().from_records(tmp)
+            tot, yut = self._year_stats()
+            logger.debug(f"making report for {len(tot)} funds")
+            # 计算产品存续期总自然日天数，日期已经解析好，直接相减
+            cnt = (tot["last"] - tot["first"]).dt.days
+            ret = tot[["Name"]].copy()
+            # 总收益按复利计算
+            ret["TotalReturn"] = np.expm1(tot["lret"])
+            # 年化收益率 = 总收益率 / 总自然日天数 * 一年自然日天数
+            ret["YearReturn"] = ret["TotalReturn"] / cnt * YEAR_TNR
+            # 总夏普
+            ret["TotalShapre"] = (ret["YearReturn"] - RATE_R_F) / (
+                tot["std"] * np.sqrt(BDAY_TNR)
+            )
+            # 总最大回撤 = 累计净值相对历史最高点的最大跌幅
+            ret["TotalMaxDrawDown"] = tot["mdd"]
+            # 按照复利计算年收益，忽略最早那天的return
+            yut["Return"] = np.expm1(yut["lret"])
+            # 年夏普
+            yut["Shapre"] = (yut["Return"] - RATE_R_F) / (
+                yut["std"] * np.sqrt(BDAY_TNR)
+            )
+            # 年最大回撤 = 当年累计净值相对历史最高点的最大跌幅
+            yut["MaxDrawDown"] = yut["mdd"]
+            # 年份列按出现顺序排：基金按报告顺序，每个基金内年份倒序，后面基金新出现的年份接在后面
+            key = yut.index.to_frame(index=False)
+            key["pos"] = tot.index.get_indexer(key["Code"])
+            key = key.sort_values(["pos", "Year"], ascending=[True, False])
+            yys = key["Year"].unique()
+            # 年份转成列，列名是{年份}_{指标}
+            col = ["Return", "Shapre", "MaxDrawDown"]
+            yut = yut[col].unstack("Year")
+            yut = yut.reindex(columns=[(cc, yy) for yy in yys for cc in col])
+            yut.columns = [f"{yy}_{cc}" for cc, yy in yut.columns]
+            # 拼成一张表，基金顺序和原数据一致
+            ret = ret.join(yut)
+            ret.index.name = "Code"
+            ret = ret.reset_index()
+        # 本地模式下代码和名称存成category，报告里统一转回字符串
+        ret = ret.astype({"Code": str, "Name": str})
         return ret
 
 
+def scrape_one(code: str, name: str) -> EMFund:
+    """
+    爬取一个基金的全部历史数据，在线程池里运行
+
+    Parameters:
+    - code (str): 基金代码
+    - name (str): 基金名称
+
+    Returns:
+    - EMFund: 已获取数据的基金实例
+    """
+    # 创建一个EastMoney基金实例
+    fund = EMFund(code, name)
+    # 获取这个基金的数据
+    fund.get_data()
+    return fund
+
+
 def inject_to_db(file: str = None) -> None:
     # 如果是用本地文件装载数据
     if file:
@@ -368,29 +858,31 @@ def inject_to_db(file: str = None) -> None:
     # 天天基金列表url
     url = "https://fund.eastmoney.com/fund.html"
     # 发送HTTP请求并获取页面内容
-    res = requests.get(url)
+    res = get_session().get(url)
     txt = res.content.decode("gb2312", "ignore")
-    # 使用BeautifulSoup解析HTML内容
-    bss = bs(txt, "html.parser")
+    # 直接用lxml解析HTML内容，用xpath定位，不经过BeautifulSoup的Python对象树
+    doc = lhtml.fromstring(txt)
     # 定位基金列表的表格
-    table = bss.find("table", {"id": "oTable"})
-    tbody = table.find("tbody")
-    # 遍历tbody中的tr
-    for i, tr in enumerate(tbody.find_all("tr")):
-        if i >= FUND_NUM:
-            break
-        # 处理每一行的内容
-        code = tr.find("td", {"class": "bzdm"}).text
-        name = tr.find("td", {"class": "tol"}).find("a").text
-        logger.info(f"{i} code={code}, name={name}")
-        # 创建一个EastMoney基金实例
-        fund = EMFund(code, name)
-        # 获取这个基金的数据
-        fund.get_data()
-        # 加入数据库
-        db.add(fund)
-        # 导出数据csv至data下
-        fund.export_data(f"{DATA_DIR}/{code}_{name}.csv")
+    tbody = doc.xpath('//table[@id="oTable"]')[0].find(".//tbody")
+    with ThreadPoolExecutor(max_workers=FUND_WORKERS) as pool:
+        futs = []
+        # 遍历tbody中的tr
+        for i, tr in enumerate(tbody.iter("tr")):
+            if i >= FUND_NUM:
+                break
+            # 处理每一行的内容
+            code = str(tr.find_class("bzdm")[0].text_content())
+            name = str(tr.find_class("tol")[0].find(".//a").text_content())
+            logger.info(f"{i} code={code}, name={name}")
+            # 多个基金同时爬取
+            futs.append(pool.submit(scrape_one, code, name))
+        # 按列表顺序取结果，数据库只在主线程里写
+        for fut in futs:
+            fund = fut.result()
+            # 加入数据库
+            db.add(fund)
+            # 导出数据csv至data下
+            fund.export_data(f"{DATA_DIR}/{fund.code}_{fund.name}.csv")
     return
 
 
@@ -400,8 +892,14 @@ if __name__ == "__main__":
     parser.add_argument(
         "-l", "--local", help="run with local files only", action="store_true"
     )
+    parser.add_argument(
+        "-r", "--refresh", help="clear cached http responses", action="store_true"
+    )
     # 解析命令行参数
     args = parser.parse_args()
+    # 清空接口返回缓存，强制重新从网络爬取，没有缓存文件就不用管
+    if args.refresh and CachedSession is not None and os.path.exists(PATH_CACHE):
+        get_session().cache.clear()
     # 创建DB实例，根据命令行参数设置为local或sqlite
     db = DBFund(args.local)
     # 从默认路径装载数据
@@ -417,9 +915,9 @@ if __name__ == "__main__":
         db.save()
     # 计算基金产品的年度评估指标
     d1 = db.make_repo(month=False)
-    d1.to_csv("data/year_repo.csv", index=False)
+    write_csv(d1, "data/year_repo.csv")
     # 计算基金产品的月度评估指标
     d2 = db.make_repo(month=True)
-    d2.to_csv("data/month_repo.csv", index=False)
+    write_csv(d2, "data/month_repo.csv")
 
     sys.exit(0)